@@ -24,35 +24,85 @@ WARNING:        This script presently does not include any safeguards to prevent
 
 """
 
-from pymeasure.instruments.keithley import Keithley2400
-from pymeasure.adapters import PrologixAdapter
+from array import array
 from datetime import datetime
+import bisect
+import csv
+import functools
+import json
+import os
 import time
-import inquirer
 
 # ********** Instrument communication **********
 
-# Revise to set smu variable for your particular GPIB / Serial Setup
+# Revise get_smu() for your particular GPIB / Serial Setup.  The connection is opened on first use
+# and shared by all callers; pymeasure is only imported at that point.
 
-# Prologix USB to GPIB
+@functools.lru_cache(maxsize=1)
+def get_smu():
 
-adapter = PrologixAdapter('/dev/cu.usbserial-PXEFMYB9', serial_timeout=0.2)
-smu = Keithley2400(adapter.gpib(26))
+    from pymeasure.instruments.keithley import Keithley2400
+    from pymeasure.adapters import PrologixAdapter
 
-# USB to RS-232 cable
+    class FastKeithley2400(Keithley2400):
 
-#smu = Keithley2400('ASRL/dev/cu.usbserial-FTCGVYZA::INSTR',
-#                   baud_rate=9600, write_termination='\r', read_termination='\r')
+        # Unvalidated shortcuts for the measurement loop.  Levels are range-checked by config_test(),
+        # so these skip pymeasure's property validation and value mapping.
+
+        def fast_set_source_current(self, level):
+            self.write(":SOUR:CURR:LEV %g" % level)
+
+        def fast_read_voltage_pair(self, test_level, restore_level):
+            # Reads the voltage at the present source level, switches to test_level and reads again, then
+            # restores restore_level, all in one program message.  :FORM:ELEM VOLT makes each :READ? return
+            # only the voltage, and the replies to the two queries come back separated by ";".
+            vpresent, vtest = self.ask(":READ?;:SOUR:CURR:LEV %g;:READ?;:SOUR:CURR:LEV %g" % (test_level, restore_level)).split(";")
+            return float(vpresent), float(vtest)
+
+        @functools.cached_property
+        def identity(self):
+            # (model, serial number, firmware revision) from *IDN?, queried once per connection
+            model, serial_number, firmware = self.id.split(",")[1:4]
+            if model.startswith("MODEL "):
+                model = model[len("MODEL "):]
+            return model, serial_number, firmware.split(" ")[0]
+
+    class LineReadPrologixAdapter(PrologixAdapter):
+
+        # PrologixAdapter.read() collects lines until the serial timeout expires, so every query costs at
+        # least serial_timeout.  Every reply this script asks for is a single line, so return as soon as
+        # its line feed arrives; serial_timeout is then only an upper bound for a slow reply.
+
+        def read(self):
+            self.write("++read eoi")
+            return self.connection.readline().decode()
+
+    # Prologix USB to GPIB; port and GPIB address can be overridden with SMU_PORT and SMU_GPIB
+
+    adapter = LineReadPrologixAdapter(os.environ.get('SMU_PORT', '/dev/cu.usbserial-PXEFMYB9'),
+                                      address=int(os.environ.get('SMU_GPIB', '26')), serial_timeout=2)
+    return FastKeithley2400(adapter)
+
+    # USB to RS-232 cable
+
+    #return FastKeithley2400('ASRL/dev/cu.usbserial-FTCGVYZA::INSTR',
+    #                        baud_rate=9600, write_termination='\r', read_termination='\r')
 
 # ********** Declare global tables **********
 
 TEST_PARAM = {}   # Global table to hold various test parameters and share them among different functions
 
+TEST_CONFIG_FILENAME = os.path.join(os.path.expanduser("~"), ".battery_discharge.json")   # Last config_test() answers
+TEST_CONFIG_KEYS = ["discharge_type", "discharge_current", "discharge_curr_list",
+                    "discharge_curr_list_average_curr", "discharge_curr_list_duration",
+                    "discharge_curr_list_max_dur_index", "max_discharge_current", "vcutoff",
+                    "measure_interval", "save_setup_and_raw_data"]   # Not comment or filename: those are per battery
+
 BATT_MODEL_RAW = {}	             # Global table to hold "raw" measured and calculated data for battery model
-BATT_MODEL_RAW["voc"] = []           # Global table to hold all measured open-circuit voltage values
-BATT_MODEL_RAW["vload"] = []         # Global table to hold all voltage values measured at load (i.e. discharge) current
-BATT_MODEL_RAW["esr"] = []           # Global table to hold all measured/calculated internal resistance values
-BATT_MODEL_RAW["tstamp"] = []        # Global table to hold all timestamp values
+BATT_MODEL_RAW["voc"] = array('d')      # Global table to hold all measured open-circuit voltage values
+BATT_MODEL_RAW["vload"] = array('d')    # Global table to hold all voltage values measured at load (i.e. discharge) current
+BATT_MODEL_RAW["esr"] = array('d')      # Global table to hold all measured/calculated internal resistance values
+BATT_MODEL_RAW["tstamp"] = array('d')   # Global table to hold all timestamp values
 
 BATT_MODEL = {}	                     # Global table to hold final model values extracted from BATT_MODEL_RAW
 BATT_MODEL["voc"] = [None] * 101     # Global table to hold final open-circuit voltage values extracted from BATT_MODEL_RAW["voc"]
@@ -61,37 +111,127 @@ BATT_MODEL["esr"] = [None] * 101     # Global table to hold final internal resis
 BATT_MODEL["tstamp"] = [None] * 101  # Global table to hold final timestamp values extracted from BATT_MODEL_RAW["tstamp"]
 BATT_MODEL["soc"] = [None] * 101     # Global table to hold state-of-charge values (0 to 100%, in 1% increments)
 
+SMU_SETPOINT = {}                     # Global table to hold settings last programmed into the SMU, so they needn't be queried
+SMU_SETPOINT["source_current"] = None # Last programmed source current; None if unknown
+SMU_SETPOINT["source_delay"] = None   # Last programmed source delay; None if unknown
+SMU_SETPOINT["voltage_range"] = None  # Measure voltage range selected in config_system; None if unknown
+
 # ********** Define Utility Functions **********
 
 def delay(interval):
     time.sleep(interval)
 
-def prompt_choice(prompt, choices):
-    questions = [
+def beep():
+    get_smu().beep(2400, 0.08)   # Short 2.4 kHz attention beep
+
+@functools.lru_cache(maxsize=None)
+def choice_questions(prompt, choices):
+    import inquirer
+    return [
         inquirer.List('choice',
                       message=prompt,
-                      choices=choices,
+                      choices=list(choices),
                       ),
         ]
-    answers = inquirer.prompt(questions)
-    return answers["choice"]
 
-def Dround(v,d):
-    return round(v,d)
+def prompt_choice(prompt, choices):
+    if len(choices) == 1:             # Nothing to choose; a plain confirmation doesn't need the inquirer menu
+        input(prompt + " (press Enter for " + choices[0] + ") ")
+        return choices[0]
+    import inquirer
+    answers = inquirer.prompt(choice_questions(prompt, tuple(choices)))
+    return answers["choice"]
 
-def meas_esr(test_curr, settle_time):
+def prompt_yes_no(prompt, default=True):
+    # Plain y/n question; an empty answer selects the default
+    answer = input(prompt + (" [Y/n]: " if default else " [y/N]: ")).strip().lower()
+    if answer == "":
+        return default
+    return answer.startswith("y")
+
+def load_test_config():
+    # Returns the TEST_PARAM entries saved by the previous run, or None if there aren't any
+    try:
+        with open(TEST_CONFIG_FILENAME) as file:
+            config = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if not valid_test_config(config):
+        return None   # Stale or hand-edited file; treat as no previous config
+    return config
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def valid_test_config(config):
+    # Checks the saved entries are complete and consistent with each other, so a reused config can't fail
+    # partway through the discharge. Limits that depend on the battery are re-checked in config_test().
+    if not isinstance(config, dict) or not all(key in config for key in TEST_CONFIG_KEYS):
+        return False
+    if not all(is_number(config[key]) for key in ("max_discharge_current", "vcutoff", "measure_interval")):
+        return False
+    if not isinstance(config["save_setup_and_raw_data"], bool):
+        return False
+
+    if config["discharge_type"] == "CONSTANT":
+        return is_number(config["discharge_current"])
+
+    if config["discharge_type"] == "LIST":
+        curr_list = config["discharge_curr_list"]
+        if not isinstance(curr_list, list) or len(curr_list) < 2 or len(curr_list) > 10:
+            return False
+        if not all(isinstance(entry, dict) and is_number(entry.get("current")) and is_number(entry.get("duration"))
+                   for entry in curr_list):
+            return False
+        if not is_number(config["discharge_curr_list_average_curr"]) or not is_number(config["discharge_curr_list_duration"]):
+            return False
+        max_dur_index = config["discharge_curr_list_max_dur_index"]
+        return isinstance(max_dur_index, int) and not isinstance(max_dur_index, bool) and 0 <= max_dur_index < len(curr_list)
+
+    return False
+
+def save_test_config():
+    # The saved config is only a convenience, so failing to write it must not abort the test
+    try:
+        with open(TEST_CONFIG_FILENAME, "w") as file:
+            json.dump({key: TEST_PARAM.get(key) for key in TEST_CONFIG_KEYS}, file, indent=2)
+    except OSError as err:
+        print(f"Warning: could not save test configuration to {TEST_CONFIG_FILENAME}: {err}")
+
+def write_batch(*cmds):
+    # Send several SCPI commands as one semicolon-separated program message (one GPIB write)
+    get_smu().write(";".join(cmds))
+
+def set_source_current(level):
+    # Skip the GPIB write if the SMU is already programmed to this level
+    if SMU_SETPOINT["source_current"] != level:
+        get_smu().fast_set_source_current(level)
+        SMU_SETPOINT["source_current"] = level
+
+def set_source_delay(interval):
+    # Skip the GPIB write if the SMU is already programmed with this delay
+    if SMU_SETPOINT["source_delay"] != interval:
+        get_smu().source_delay = interval
+        SMU_SETPOINT["source_delay"] = interval
+
+def meas_esr(load_curr, test_curr, settle_time):
+
+    smu = get_smu()
 
     # load_curr and test_curr are load currents, which are drawn from the battery.
     # To draw current FROM the battery, the programmed current level must be negative (or zero).
+    # load_curr is the level the caller last programmed, so it is not read back from the SMU.
+    # settle_time is applied by the SMU as its source delay, between sourcing and measuring on every
+    # reading, so the host doesn't sleep while the battery settles.
     
     test_curr = -abs(test_curr)           # Ensure test_curr has proper sense
-    load_curr = smu.source_current        # Will be negative
-    vload = smu.voltage                   # Battery voltage at load_curr
-    smu.source_current = -abs(test_curr)  # test_curr equal to zero corresponds to an open circuit
-    if settle_time > 0:
-        delay(settle_time)
-    vtest = smu.voltage                   # Battery voltage at test_curr; vtest is Voc if test_curr = 0
-    smu.source_current = load_curr
+    load_curr = -abs(load_curr)           # Ensure load_curr has proper sense
+    set_source_delay(settle_time)
+    set_source_current(load_curr)         # Normally already programmed by the caller, so no GPIB write
+
+    # vload is the battery voltage at load_curr; vtest is the battery voltage at test_curr, which is Voc
+    # if test_curr = 0 (an open circuit).  The source is back at load_curr when this returns.
+    vload, vtest = smu.fast_read_voltage_pair(test_curr, load_curr)
     esr = abs((vtest - vload) / (test_curr - load_curr)) # (V2-V1)/(I2-I1); ensure positive resistance
     return vload, vtest, esr
 
@@ -99,11 +239,16 @@ def meas_esr(test_curr, settle_time):
 
 def config_system(do_beeps, debug):
 
+    smu = get_smu()
+
     smu.reset()
 
+    for setting in SMU_SETPOINT:       # Settings programmed before the reset no longer apply
+        SMU_SETPOINT[setting] = None
+
     # Cofigure terminals
     if do_beeps:
-        smu.beep(2400, 0.08)
+        beep()
 
     terminals = prompt_choice("Select TERMINALS you want to use:", ["Front", "Rear"])
 
@@ -114,28 +259,34 @@ def config_system(do_beeps, debug):
 
     TEST_PARAM["terminals"] = terminals
 
-    # Configure source settings
-    smu.source_mode = "current"
-    smu.output_off_state = 'HIMP'      # SMU is disconnected from output terminals when SMU output is OFF
-
-    smu.source_current = 0.0           # Amps; zero is default value
-    smu.source_current_range = 0.001   # Amps; automatically disables source autorange.
-    smu.source_delay = 0.0             # Seconds; automatically disables source autodelay
-
-    # Configure measure setting
-    smu.measure_voltage()
-
-    smu.wires = 4
-
-    smu.compliance_voltage = 210       # Volts
-    smu.voltage_range = 200            # Volts
-
-    smu.auto_range_source()
-    smu.voltage_nplc = 1
+    # Configure source and measure settings in a single GPIB write
+    write_batch(
+        ":SOUR:FUNC CURR",             # Source current
+        ":OUTP:SMOD HIMP",             # SMU is disconnected from output terminals when SMU output is OFF
+        ":SOUR:CURR:LEV 0",            # Amps; zero is default value
+        ":SOUR:CURR:RANG:AUTO 1",      # Source autorange
+        ":SOUR:DEL 0",                 # Seconds; automatically disables source autodelay
+        ":DISP:ENAB OFF",              # Skip front panel updates; re-enabled when the script exits
+        ":SYST:AZER:STAT OFF",         # Auto-zero roughly triples reading time (each reading ~1 NPLC instead of ~3;
+                                       # 1 NPLC = 20 ms at 50 Hz). The discharge loops request one auto-zero per
+                                       # measurement interval with smu.auto_zero = "ONCE" instead. Re-enabled
+                                       # when the script exits.
+        ":SENS:FUNC:CONC OFF",         # Measure only one function
+        ":SENS:FUNC 'VOLT'",           # Measure voltage
+        ":FORM:ELEM VOLT",             # Return only the voltage reading
+        ":SYST:RSEN 1",                # 4-wire (remote sense)
+        ":SENS:VOLT:PROT 210",         # Volts
+        ":SENS:VOLT:RANG 200",         # Volts; automatically disables measure autoranging
+        ":SENS:VOLT:NPLC 1")
+
+    smu.ask("*OPC?")                   # Wait for the configuration to complete
+
+    SMU_SETPOINT["source_current"] = 0.0
+    SMU_SETPOINT["source_delay"] = 0.0
 
     print("Make 4-wire connections to your battery at the SMU " + terminals + " terminals\nand choose OK.")
     if do_beeps:
-        smu.beep(2400, 0.08)
+        beep()
 
     prompt_choice("Proceed?", ["OK"])
 
@@ -144,63 +295,119 @@ def config_system(do_beeps, debug):
     scrap_reading = smu.voltage   # Measure voltage to set range
 
     if debug:
+        voltage_range, compliance_voltage = smu.ask(":SENS:VOLT:RANG?;:SENS:VOLT:PROT?").split(";")
         print("\nIn ConfigSystem()...")
-        print("\nterminals = "+ terminals)
-        print("\nsmu.voltage_range (before ranging) = " + str(smu.voltage_range))
-        print("\nsmu.compliance_voltage = " + str(smu.compliance_voltage))
-        print("\nscrap_reading = " + str(scrap_reading))
+        print(f"\nterminals = {terminals}")
+        print(f"\nsmu.voltage_range (before ranging) = {float(voltage_range)}")
+        print(f"\nsmu.compliance_voltage = {float(compliance_voltage)}")
+        print(f"\nscrap_reading = {scrap_reading}")
 
-    smu.voltage_range = scrap_reading   # Automatically disables measure autoranging
-    smu.compliance_voltage = 1.05 * smu.voltage_range   # When forcing current, the source voltage limit MUST ALWAYS be kept greater than the DUT voltage
-                                                        # Both real and range compliance should be avoided
+    # Set the range (automatically disables measure autoranging) and read back the range the SMU actually selected
+    voltage_range = float(smu.ask(":SENS:VOLT:RANG:AUTO 0;:SENS:VOLT:RANG %g;:SENS:VOLT:RANG?" % scrap_reading))
+    SMU_SETPOINT["voltage_range"] = voltage_range
+    compliance_voltage = 1.05 * voltage_range   # When forcing current, the source voltage limit MUST ALWAYS be kept greater than the DUT voltage
+                                                # Both real and range compliance should be avoided
 
-    TEST_PARAM["initial_voc"] = smu.voltage      # Capture an initial voltage measurement for system check
+    # Set the compliance and capture an initial voltage measurement for system check
+    TEST_PARAM["initial_voc"] = float(smu.ask(":SENS:VOLT:PROT %g;:READ?" % compliance_voltage))
 
     smu.source_enabled = False
 
     if debug:
-        print("\nsmu.voltage_range (after raning) = " + str(smu.voltage_range))
-        print("\nsmu.compliance_voltage = " + str(smu.compliance_voltage))
-        print("\nTEST_PARAM[\"initial_voc\"] = " + str(TEST_PARAM["initial_voc"]))
+        print(f"\nsmu.voltage_range (after raning) = {voltage_range}")
+        print(f"\nsmu.compliance_voltage = {compliance_voltage}")
+        print(f"\nTEST_PARAM[\"initial_voc\"] = {TEST_PARAM['initial_voc']}")
 
     if TEST_PARAM["initial_voc"] < 0.1:
         raise ValueError("Initial Voc below 0.1 V; config_system aborted")
 
-    print("Measured battery voltage = " + "{0:.3f}".format(TEST_PARAM["initial_voc"]) + "V.\nChoose OK to continue or Cancel to quit.")
+    print(f"Measured battery voltage = {TEST_PARAM['initial_voc']:.3f}V.\nChoose OK to continue or Cancel to quit.")
     if do_beeps:
-        smu.beep(2400, 0.08)
+        beep()
     choice = prompt_choice("Proceed?", ["OK", "Cancel"])
     if choice == "Cancel":
         raise Exception("config_system aborted by user")
 
+def prompt_comment():
+    comment = input("Enter Comment (64 char max): ")
+    if comment == "":
+        comment = "NO COMMENT"
+    TEST_PARAM["comment"] = comment
+    return comment
+
+def prompt_batt_model_filename():
+    # Ask again rather than silently replace the model or raw data of an earlier battery
+    while True:
+        filename = input("Enter battery model filename: ")
+        if filename == "":
+            filename = "unnamed"
+            print("No name given, using \"unnamed\"")
+
+        existing = [name for name in (filename + ".csv", filename + "_SetupAndRawData.csv") if os.path.exists(name)]
+        if not existing or prompt_yes_no(f"{' and '.join(existing)} already exist{'s' if len(existing) == 1 else ''}. Overwrite?", default=False):
+            break
+
+    TEST_PARAM["batt_model_filename"] = filename + ".csv"
+
 def config_test(do_beeps, debug):
 
     max_allowed_current = None
 
-    if smu.voltage_range == 200:         # Volts
+    if SMU_SETPOINT["voltage_range"] == 200:   # Volts
         max_allowed_current = 0.105      # Amps
     else:
         max_allowed_current = 1.05       # Amps
 
+    # Set maximum cut-off voltage to 98% of TEST_PARAM["initial_voltage"]   
+    cov_max = round(0.98 * TEST_PARAM["initial_voc"], 2)
+
+    previous_config = load_test_config()
+    if previous_config is not None:
+
+        if do_beeps:
+            beep()
+
+        if prompt_yes_no("Reuse test configuration from the previous run?", default=False):
+
+            # Limits depend on the battery and ranging from config_system, so check them again
+            if previous_config["max_discharge_current"] > max_allowed_current:
+                raise ValueError(f"Unallowed discharge current: {previous_config['max_discharge_current']}")
+            if previous_config["vcutoff"] < 0.1 or previous_config["vcutoff"] > cov_max:
+                raise ValueError(f"Unallowed cutoff voltage: {previous_config['vcutoff']}")
+            if previous_config["measure_interval"] < 1 or previous_config["measure_interval"] > 600:
+                raise ValueError(f"Unallowed measure interval: {previous_config['measure_interval']}")
+
+            TEST_PARAM.update((key, previous_config[key]) for key in TEST_CONFIG_KEYS)
+
+            if do_beeps:
+                beep()
+
+            comment = prompt_comment()
+            prompt_batt_model_filename()
+
+            if debug:
+                print("\nIn config_test()...")
+                print(f"\nReusing {TEST_CONFIG_FILENAME}: {previous_config}")
+                print(f"\ncomment = {comment}")
+                print(f"\nTEST_PARAM[\"batt_model_filename\"] = {TEST_PARAM['batt_model_filename']}")
+            return
+
     if do_beeps:
-        smu.beep(2400, 0.08)
+        beep()
 
-    comment = input("Enter Comment (64 char max): ")
-    if comment == "":
-        comment = "NO COMMENT"
-    TEST_PARAM["comment"] = comment
+    comment = prompt_comment()
 
     if do_beeps:
-        smu.beep(2400, 0.08)
+        beep()
 
     discharge_type = prompt_choice("Select Discharge Type:", ["Constant Curr", "Current List"])
 
     if debug:
         print("\nIn config_test()...")
-        print("\nsmu.voltage_range = " + str(smu.voltage_range))
-        print("\nmax_allowed_current = " + str(max_allowed_current))
-        print("\ncomment = " + comment)
-        print("\ndischarge_type = " + discharge_type)
+        print(f"\nsmu.voltage_range = {SMU_SETPOINT['voltage_range']}")
+        print(f"\nmax_allowed_current = {max_allowed_current}")
+        print(f"\ncomment = {comment}")
+        print(f"\ndischarge_type = {discharge_type}")
 
     if discharge_type == "Constant Curr":
         
@@ -209,16 +416,16 @@ def config_test(do_beeps, debug):
         dialog_text = "Discharge Curr (1E-6 to " + str(max_allowed_current) + "A): "
         TEST_PARAM["discharge_current"] = float(input(dialog_text))
         if TEST_PARAM["discharge_current"] < 1e-6 or TEST_PARAM["discharge_current"] > max_allowed_current:
-            raise ValueError("Unallowed discharge current: " + str(TEST_PARAM["discharge_current"]))
+            raise ValueError(f"Unallowed discharge current: {TEST_PARAM['discharge_current']}")
 
         TEST_PARAM["discharge_curr_list"] = None   # If discharge_type is CONSTANT, then there is no current list
         TEST_PARAM["max_discharge_current"] = TEST_PARAM["discharge_current"] # and discharge_current is the max_discharge_current
 
         if debug:
-            print("\nTEST_PARAM[\"discharge_type\"] = " + TEST_PARAM["discharge_type"])
-            print("\nTEST_PARAM[\"discharge_current\"] = " + str(TEST_PARAM["discharge_current"]))
-            print("\nTEST_PARAM[\"discharge_curr_list\"] = " + str(TEST_PARAM["discharge_curr_list"]))
-            print("\nTEST_PARAM[\"max_discharge_current\"] = " + str(TEST_PARAM["max_discharge_current"]))
+            print(f"\nTEST_PARAM[\"discharge_type\"] = {TEST_PARAM['discharge_type']}")
+            print(f"\nTEST_PARAM[\"discharge_current\"] = {TEST_PARAM['discharge_current']}")
+            print(f"\nTEST_PARAM[\"discharge_curr_list\"] = {TEST_PARAM['discharge_curr_list']}")
+            print(f"\nTEST_PARAM[\"max_discharge_current\"] = {TEST_PARAM['max_discharge_current']}")
 
     else:  # If Current List selected
 
@@ -227,116 +434,96 @@ def config_test(do_beeps, debug):
 
         npoints = int(input("Number of Pts in List (2 to 10): "))
         if npoints < 2 or npoints > 10:
-            raise ValueError("Unallowed number of points: " + str(npoints))
+            raise ValueError(f"Unallowed number of points: {npoints}")
 
         TEST_PARAM["discharge_curr_list"] = [None] * npoints   # Create array to hold current list values
         
         if debug:
-            print("\nTEST_PARAM[\"discharge_type\"] = " + TEST_PARAM["discharge_type"])
-            print("\nTEST_PARAM[\"discharge_current\"] = " + str(TEST_PARAM["discharge_current"]))
-            print("\nTEST_PARAM[\"discharge_curr_list\"] = " + str(TEST_PARAM["discharge_curr_list"]))
-            print("\nnpoints = " + str(npoints))
+            print(f"\nTEST_PARAM[\"discharge_type\"] = {TEST_PARAM['discharge_type']}")
+            print(f"\nTEST_PARAM[\"discharge_current\"] = {TEST_PARAM['discharge_current']}")
+            print(f"\nTEST_PARAM[\"discharge_curr_list\"] = {TEST_PARAM['discharge_curr_list']}")
+            print(f"\nnpoints = {npoints}")
 
+        # Accumulate the list statistics in the same pass that reads the list points
         average_curr = 0
         list_duration = 0
+        max_specified_current = 0
+        maxdur = 0
+        max_dur_index = None   # Primary step in the sweep where ESR will be measured: longest duration,
+                               # ties broken by highest current
 
         for i in range(0,npoints):
 
             TEST_PARAM["discharge_curr_list"][i] = {} # Create dictionary to hold current level and duration for list point i
 
             dialog_text = "Dischrg Curr #" + str(i+1) + " (1E-6 to " + str(max_allowed_current) + "A): "
-            TEST_PARAM["discharge_curr_list"][i]["current"] = float(input(dialog_text))
-            if TEST_PARAM["discharge_curr_list"][i]["current"] < 1e-6 or TEST_PARAM["discharge_curr_list"][i]["current"] > max_allowed_current:
-                raise ValueError("Unallowed discharge current: " + str(TEST_PARAM["discharge_curr_list"][i]["current"]))
+            current = float(input(dialog_text))
+            if current < 1e-6 or current > max_allowed_current:
+                raise ValueError(f"Unallowed discharge current: {current}")
+            TEST_PARAM["discharge_curr_list"][i]["current"] = current
+
+            duration = float(input("Curr #" + str(i+1) + " Duration (s, 1s min): "))
+            if duration < 1:
+                raise ValueError(f"Unallowed discharge duration: {duration}")
+            TEST_PARAM["discharge_curr_list"][i]["duration"] = duration
 
-            TEST_PARAM["discharge_curr_list"][i]["duration"] = float(input("Curr #" + str(i+1) + " Duration (s, 1s min): "))
-            if TEST_PARAM["discharge_curr_list"][i]["duration"] < 1:
-                raise ValueError("Unallowed discharge duration: " + str(TEST_PARAM["discharge_curr_list"][i]["duration"]))
+            average_curr = average_curr + current * duration
+            list_duration = list_duration + duration
 
-            average_curr = average_curr + TEST_PARAM["discharge_curr_list"][i]["current"] * TEST_PARAM["discharge_curr_list"][i]["duration"]
-            list_duration = list_duration + TEST_PARAM["discharge_curr_list"][i]["duration"]
+            if current > max_specified_current:
+                max_specified_current = current
+
+            if duration > maxdur or (duration == maxdur and current > TEST_PARAM["discharge_curr_list"][max_dur_index]["current"]):
+                maxdur = duration
+                max_dur_index = i
 
             if debug:
-                print("\nTEST_PARAM[\"discharge_curr_list\"][" + str(i) + "][\"current\"] = " + str(TEST_PARAM["discharge_curr_list"][i]["current"]))
-                print("\nTEST_PARAM[\"discharge_curr_list\"][" + str(i) + "][\"duration\"] = " + str(TEST_PARAM["discharge_curr_list"][i]["duration"]))
+                print(f"\nTEST_PARAM[\"discharge_curr_list\"][{i}][\"current\"] = {current}")
+                print(f"\nTEST_PARAM[\"discharge_curr_list\"][{i}][\"duration\"] = {duration}")
 
         average_curr = average_curr / list_duration
         TEST_PARAM["discharge_curr_list_average_curr"] = average_curr
         TEST_PARAM["discharge_curr_list_duration"] = list_duration
-
-        max_specified_current = TEST_PARAM["discharge_curr_list"][0]["current"]
-        for i in range(1,npoints):
-            if TEST_PARAM["discharge_curr_list"][i]["current"] > max_specified_current:
-                max_specified_current = TEST_PARAM["discharge_curr_list"][i]["current"]
         TEST_PARAM["max_discharge_current"] = max_specified_current
-
-        
-        maxdur = TEST_PARAM["discharge_curr_list"][0]["duration"]
-        for i in range(1,npoints):
-            if TEST_PARAM["discharge_curr_list"][i]["duration"] > maxdur:
-                maxdur = TEST_PARAM["discharge_curr_list"][i]["duration"]
-	
-        # Create array of list points with duration equal to maxdur
-        maxdur_indices = []
-        for i in range(0, npoints):
-            if TEST_PARAM["discharge_curr_list"][i]["duration"] == maxdur:
-                maxdur_indices.append(i)
-
-        # Determine the primary step in the sweep where ESR will be measured
-        max_dur_index = None
-        if len(maxdur_indices) == 1:
-            max_dur_index = maxdur_indices[0]
-        else:
-            maxcurr = TEST_PARAM["discharge_curr_list"][maxdur_indices[0]]["current"]
-            for i in range(1,len(maxdur_indices)):
-                if TEST_PARAM["discharge_curr_list"][maxdur_indices[i]]["current"] > maxcurr:
-                    maxcurr = TEST_PARAM["discharge_curr_list"][maxdur_indices[i]]["current"]
-                    max_dur_index = maxdur_indices[i]
-
         TEST_PARAM["discharge_curr_list_max_dur_index"] = max_dur_index
 
         if debug:
-            print("\nTEST_PARAM[\"discharge_curr_list_average_curr\"] = " + str(TEST_PARAM["discharge_curr_list_average_curr"]))
-            print("\nTEST_PARAM[\"discharge_curr_list_duration\"] = " + str(TEST_PARAM["discharge_curr_list_duration"]))
-            print("\nTEST_PARAM[\"max_discharge_current\"] = " + str(TEST_PARAM["max_discharge_current"]))
-            print("\nmaxdur = " + str(maxdur))
-            print("\nlen(maxdur_indices) = " + str(len(maxdur_indices)))
-
-    # Set maximum cut-off voltage to 98% of TEST_PARAM["initial_voltage"]   
-    cov_max = Dround(0.98 * TEST_PARAM["initial_voc"], 2)
+            print(f"\nTEST_PARAM[\"discharge_curr_list_average_curr\"] = {TEST_PARAM['discharge_curr_list_average_curr']}")
+            print(f"\nTEST_PARAM[\"discharge_curr_list_duration\"] = {TEST_PARAM['discharge_curr_list_duration']}")
+            print(f"\nTEST_PARAM[\"max_discharge_current\"] = {TEST_PARAM['max_discharge_current']}")
+            print(f"\nmaxdur = {maxdur}")
+            print(f"\nmax_dur_index = {max_dur_index}")
 
     # Set default cut-off voltage to 50% of TEST_PARAM["initial_voltage"].
-    cov_default = Dround(0.5 * TEST_PARAM["initial_voc"], 2)
+    cov_default = round(0.5 * TEST_PARAM["initial_voc"], 2)
 
     dialog_text = "Cut-off Voltage (0.1 to " + str(cov_max) + "V): " # 100mV is arbitrary minimum
     TEST_PARAM["vcutoff"] = float(input(dialog_text))
     if TEST_PARAM["vcutoff"] < 0.1 or TEST_PARAM["vcutoff"] > cov_max:
-        raise ValueError("Unallowed cutoff voltage: " + str(TEST_PARAM["vcutoff"]))
+        raise ValueError(f"Unallowed cutoff voltage: {TEST_PARAM['vcutoff']}")
 
     if debug:
-        print("\ncov_max = "+ str(cov_max))
-        print("\ncov_default = "+ str(cov_default))
-        print("TEST_PARAM[\"vcutoff\"] = "+ str(TEST_PARAM["vcutoff"]))
+        print(f"\ncov_max = {cov_max}")
+        print(f"\ncov_default = {cov_default}")
+        print(f"TEST_PARAM[\"vcutoff\"] = {TEST_PARAM['vcutoff']}")
 
     TEST_PARAM["measure_interval"] = float(input("ESR Meas Interval (1 to 600s): "))
     if TEST_PARAM["measure_interval"] < 1 or TEST_PARAM["measure_interval"] > 600:
-        raise ValueError("Unalllowed measure interval: " + str(TEST_PARAM["measure_interval"]))
+        raise ValueError(f"Unalllowed measure interval: {TEST_PARAM['measure_interval']}")
 
     if debug:
-        print("\nTEST_PARAM[\"measure_interval\"] = " + str(TEST_PARAM["measure_interval"]))
+        print(f"\nTEST_PARAM[\"measure_interval\"] = {TEST_PARAM['measure_interval']}")
 
-    filename = input("Enter battery model filename: ")
-    if filename == "":
-        filename = "unnamed"
-        print("No name given, using \"unnamed\"")
+    prompt_batt_model_filename()
 
-    TEST_PARAM["batt_model_filename"] = filename + ".csv"
+    TEST_PARAM["save_setup_and_raw_data"] = prompt_yes_no("Do you want to save setup info and raw data?")
 
-    choice = prompt_choice("Do you want to save setup info and raw data?", ["YES", "NO"])
-    TEST_PARAM["save_setup_and_raw_data"] = choice == "YES"
+    save_test_config()
 
 def do_constant_curr_discharge(debug):
 
+    smu = get_smu()
+
     # Create local aliases for global tables
     voc_tbl = BATT_MODEL_RAW["voc"]
     vload_tbl = BATT_MODEL_RAW["vload"]
@@ -353,7 +540,6 @@ def do_constant_curr_discharge(debug):
     azero_duration = 2 * smu.voltage_nplc / smu.line_frequency + azero_overhead  # Approximate execution time of autozero
 
     meas_intrvl = TEST_PARAM["measure_interval"]
-    loop_delay = max(meas_intrvl / 10000, 0.001)
     tstart_meas_intrvl = None
 
     counter = 0
@@ -361,21 +547,21 @@ def do_constant_curr_discharge(debug):
 
     # Initialize SMU output
     smu.source_current_range = TEST_PARAM["max_discharge_current"]  # Use fixed source range
-    smu.source_current = -1*TEST_PARAM["discharge_current"]   # Negative current because drawing current from battery
+    load_curr = -1*TEST_PARAM["discharge_current"]   # Negative current because drawing current from battery
+    set_source_current(load_curr)
 
     TEST_PARAM["discharge_start_time"] = datetime.now().strftime("%m/%d/%y %H:%M:%S")
     smu.source_enabled = True
 
     delay(0.1)	# Allow some settling time; required time is TBD
 
-    t0 = time.time()
+    t0 = time.monotonic()
 
     if debug:
         print("\nIn do_constant_curr_discharge()...")
         print("\nazero_overhead = " + str(azero_overhead)) 
         print("\nazero_duration = "+ str(azero_duration))
         print("\nmeas_intrvl = " + str(meas_intrvl))
-        print("loop_delay = " + str(loop_delay))
         print("\nTEST_PARAM[\"discharge_start_time\"] = " + TEST_PARAM["discharge_start_time"])
         print("\ncounter, tstamp, voc, vload, esr")
 
@@ -383,16 +569,14 @@ def do_constant_curr_discharge(debug):
 
         smu.auto_zero = "ONCE"
 
-        tstart_meas_intrvl = round(time.time() - t0, 3)
+        tstart_meas_intrvl = time.monotonic() - t0
 
-        vload_tbl.append(None)
-        voc_tbl.append(None)
-        esr_tbl.append(None)
-        tstamp_tbl.append(None)
-        
-        vload_tbl[counter], voc_tbl[counter], esr_tbl[counter] = meas_esr(0, 0.01)  # Proper settle_time is still TBD
+        vload, voc, esr = meas_esr(load_curr, 0, 0.01)  # Proper settle_time is still TBD
 
-        tstamp_tbl[counter] = tstart_meas_intrvl
+        vload_tbl.append(vload)
+        voc_tbl.append(voc)
+        esr_tbl.append(esr)
+        tstamp_tbl.append(round(tstart_meas_intrvl, 3))
 
         if debug:
             print(counter, tstamp_tbl[counter], voc_tbl[counter], vload_tbl[counter], esr_tbl[counter])
@@ -402,12 +586,14 @@ def do_constant_curr_discharge(debug):
             quit = True
             break
 
-        while (round(time.time() - t0, 3) - tstart_meas_intrvl) < (meas_intrvl - azero_duration):
-            delay(loop_delay)
+        # Sleep until the start of the next measure interval
+        remaining = tstart_meas_intrvl + meas_intrvl - azero_duration - (time.monotonic() - t0)
+        if remaining > 0:
+            delay(remaining)
 
         counter = counter + 1
 
-    smu.source_current = 0
+    set_source_current(0)
     smu.source_enabled = False
 
     TEST_PARAM["discharge_stop_time"] = datetime.now().strftime("%m/%d/%y %H:%M:%S")
@@ -420,6 +606,8 @@ def do_constant_curr_discharge(debug):
 
 def do_curr_list_discharge(settle_delay,debug):
 
+    smu = get_smu()
+
     # Create local aliases for global tables
     voc_tbl = BATT_MODEL_RAW["voc"]
     vload_tbl = BATT_MODEL_RAW["vload"]
@@ -459,7 +647,7 @@ def do_curr_list_discharge(settle_delay,debug):
 
     # Initialize SMU output
     smu.source_current_range = TEST_PARAM["max_discharge_current"]  # Considering changing to autorange depending on required dynamic range
-    smu.source_current = 0
+    set_source_current(0)
 
     TEST_PARAM["discharge_start_time"] = datetime.now().strftime("%m/%d/%y %H:%M:%S")
 
@@ -469,7 +657,7 @@ def do_curr_list_discharge(settle_delay,debug):
         print("\nTEST_PARAM[\"discharge_start_time\"] = " + TEST_PARAM["discharge_start_time"])
         print("\ncounter, tstamp, voc, iload, vload, esr")
 
-    t0 = time.time()
+    t0 = time.monotonic()
 
     if max_dur_index == 0:
 
@@ -479,7 +667,8 @@ def do_curr_list_discharge(settle_delay,debug):
 
         counter = 0
 
-        smu.source_current = -curr_list_tbl[max_dur_index]["current"]   # Negative current because drawing current from battery
+        load_curr = -curr_list_tbl[max_dur_index]["current"]   # Negative current because drawing current from battery
+        set_source_current(load_curr)
 
         # Allow some settling time; required time is TBD
         if settle_delay - azero_duration > 0:
@@ -488,22 +677,20 @@ def do_curr_list_discharge(settle_delay,debug):
         smu.auto_zero = "ONCE"
 
         # Start Trigger Timer 1
-        t1 = time.time() 
+        t1 = time.monotonic() 
 
-        tmeas = time.time() - t0
+        tmeas = time.monotonic() - t0
 
-        vload_tbl.append(None)
-        voc_tbl.append(None)
-        esr_tbl.append(None)
-        tstamp_tbl.append(None)
-        
-        # MeasESR(test_curr, settle_time)
-        vload_tbl[counter], voc_tbl[counter], esr_tbl[counter] = meas_esr(0, 0.01)  # Proper settle_time is still TBD
+        # MeasESR(load_curr, test_curr, settle_time)
+        vload, voc, esr = meas_esr(load_curr, 0, 0.01)  # Proper settle_time is still TBD
 
-        tstamp_tbl[counter] = tmeas
+        vload_tbl.append(vload)
+        voc_tbl.append(voc)
+        esr_tbl.append(esr)
+        tstamp_tbl.append(tmeas)
 
         if debug:
-            print(counter, tstamp_tbl[counter], voc_tbl[counter], -smu.source_current, vload_tbl[counter], esr_tbl[counter])
+            print(counter, tstamp_tbl[counter], voc_tbl[counter], -load_curr, vload_tbl[counter], esr_tbl[counter])
 
         if vload_tbl[counter] <= TEST_PARAM["vcutoff"]:
             quit = True
@@ -512,9 +699,10 @@ def do_curr_list_discharge(settle_delay,debug):
 
         for i in range(0, npoints):
 
-            smu.source_current = -curr_list_tbl[i]["current"]   # Negative current because drawing current from battery
+            load_curr = -curr_list_tbl[i]["current"]   # Negative current because drawing current from battery
+            set_source_current(load_curr)
 
-            tstart_step = time.time() - t0
+            tstart_step = time.monotonic() - t0
 
             if curr_list_tbl[i]["current"] == curr_list_tbl[max_dur_index]["current"]:
 
@@ -529,51 +717,48 @@ def do_curr_list_discharge(settle_delay,debug):
                     smu.auto_zero = "ONCE"
 
                     # Start Trigger Timer 1
-                    t1 = time.time()
+                    t1 = time.monotonic()
 
-                    tmeas = time.time() - t0
+                    tmeas = time.monotonic() - t0
 
-                    vload_tbl.append(None)
-                    voc_tbl.append(None)
-                    esr_tbl.append(None)
-                    tstamp_tbl.append(None)
-        
-                    vload_tbl[counter], voc_tbl[counter], esr_tbl[counter] = meas_esr(0, 0.01)  # Proper settle_time is still TBD
-                    tstamp_tbl[counter] = tmeas
+                    vload, voc, esr = meas_esr(load_curr, 0, 0.01)  # Proper settle_time is still TBD
+
+                    vload_tbl.append(vload)
+                    voc_tbl.append(voc)
+                    esr_tbl.append(esr)
+                    tstamp_tbl.append(tmeas)
 
                     if vload_tbl[counter] <= TEST_PARAM["vcutoff"]:
                         quit = True
 
                     if debug:
-                        print(counter, tstamp_tbl[counter], voc_tbl[counter], -smu.source_current, vload_tbl[counter], esr_tbl[counter])
+                        print(counter, tstamp_tbl[counter], voc_tbl[counter], -load_curr, vload_tbl[counter], esr_tbl[counter])
 
-                while not(quit) and time.time() - t0 - tstart_step < curr_list_tbl[i]["duration"]:
+                while not(quit) and time.monotonic() - t0 - tstart_step < curr_list_tbl[i]["duration"]:
 
                     # Wait up to meas_intrvl
-                    while time.time() - t1 < meas_intrvl:
-                        delay(0.001)
+                    remaining = meas_intrvl - (time.monotonic() - t1)
+                    if remaining > 0:
+                        delay(remaining)
 
                     counter = counter + 1
 
                     smu.auto_zero = "ONCE"
 
-                    tmeas = time.time() - t0
+                    tmeas = time.monotonic() - t0
 
-                    vload_tbl.append(None)
-                    voc_tbl.append(None)
-                    esr_tbl.append(None)
-                    tstamp_tbl.append(None)
-        
-                    vload_tbl[counter], voc_tbl[counter], esr_tbl[counter] = meas_esr(0, 0.01)  # Proper settle_time is still TBD
+                    vload, voc, esr = meas_esr(load_curr, 0, 0.01)  # Proper settle_time is still TBD
 
-                    tstamp_tbl[counter] = tmeas
+                    vload_tbl.append(vload)
+                    voc_tbl.append(voc)
+                    esr_tbl.append(esr)
+                    tstamp_tbl.append(tmeas)
 
                     if debug:
-                        print(counter, tstamp_tbl[counter], voc_tbl[counter], -smu.source_current, vload_tbl[counter], esr_tbl[counter])
-
-                    print("Total time=" + str(Dround(tmeas,0)) + " s")
+                        print(counter, tstamp_tbl[counter], voc_tbl[counter], -load_curr, vload_tbl[counter], esr_tbl[counter])
 
-                    print("Voc=" + "{0:.2f}".format(voc_tbl[counter]) + " Vload=" + "{0:.2f}".format(vload_tbl[counter]) + " ESR=" + "{0:.4f}".format(esr_tbl[counter]))
+                    if debug or counter % 10 == 0:   # Progress report every 10th measurement
+                        print(f"Total time={round(tmeas, 0)} s\nVoc={voc:.2f} Vload={vload:.2f} ESR={esr:.4f}")
 
                     if vload_tbl[counter] <= TEST_PARAM["vcutoff"]:
                         quit = True
@@ -589,7 +774,7 @@ def do_curr_list_discharge(settle_delay,debug):
             if quit:
                 break
 
-    smu.source_current = 0
+    set_source_current(0)
     smu.source_enabled = False
 
     TEST_PARAM["discharge_stop_time"] = datetime.now().strftime("%m/%d/%y %H:%M:%S")
@@ -613,11 +798,13 @@ def extract_model(debug):
 
     model_interval = tstamp_tbl[max_index] / 100
 
+    ts_rel = [t - tstamp_tbl[0] for t in tstamp_tbl]   # Raw timestamps relative to the first raw timestamp
+
     BATT_MODEL["soc"][100] = 100     # 100 % state of charge
     BATT_MODEL["voc"][100] = voc_tbl[0]
     BATT_MODEL["vload"][100] = vload_tbl[0]
     BATT_MODEL["esr"][100] = esr_tbl[0]
-    BATT_MODEL["tstamp"][100] = tstamp_tbl[0] - tstamp_tbl[0]  # Calculate model timestamps relative to timestamp of first raw timestamp
+    BATT_MODEL["tstamp"][100] = ts_rel[0]  # Calculate model timestamps relative to timestamp of first raw timestamp
 
     if debug:
         print("\nIn extract_model()...")
@@ -634,22 +821,20 @@ def extract_model(debug):
         soc_index = soc
         BATT_MODEL["soc"][soc_index] = soc	
         target_time = (100 - soc) * model_interval
-        i = start_index
 
-        while (tstamp_tbl[i] - tstamp_tbl[0]) < target_time:
-            i = i + 1
-            if i > max_index:
-                i = max_index
-                break
-            
-        if (tstamp_tbl[i] - tstamp_tbl[0]) > target_time:
+        # First raw point at or after target_time; timestamps are increasing, so binary search from start_index
+        i = bisect.bisect_left(ts_rel, target_time, start_index)
+        if i > max_index:
+            i = max_index
+
+        if ts_rel[i] > target_time:
             
-            if ((tstamp_tbl[i] - tstamp_tbl[0]) - target_time) < (target_time - (tstamp_tbl[i-1] - tstamp_tbl[0])):
+            if (ts_rel[i] - target_time) < (target_time - ts_rel[i-1]):
                 
                 BATT_MODEL["voc"][soc_index] = voc_tbl[i]
                 BATT_MODEL["vload"][soc_index] = vload_tbl[i]
                 BATT_MODEL["esr"][soc_index] = esr_tbl[i]
-                BATT_MODEL["tstamp"][soc_index] = tstamp_tbl[i] - tstamp_tbl[0]    # Calculate model timestamps relative to timestamp of first raw timestamp
+                BATT_MODEL["tstamp"][soc_index] = ts_rel[i]    # Calculate model timestamps relative to timestamp of first raw timestamp
                 start_index = i
 
             else:
@@ -657,15 +842,15 @@ def extract_model(debug):
                 BATT_MODEL["voc"][soc_index] = voc_tbl[i-1]
                 BATT_MODEL["vload"][soc_index] = vload_tbl[i-1]
                 BATT_MODEL["esr"][soc_index] = esr_tbl[i-1]
-                BATT_MODEL["tstamp"][soc_index] = tstamp_tbl[i-1] - tstamp_tbl[0]  # Calculate model timestamps relative to timestamp of first raw timestamp
+                BATT_MODEL["tstamp"][soc_index] = ts_rel[i-1]  # Calculate model timestamps relative to timestamp of first raw timestamp
                 start_index = i - 1
 
-        else:   # if (tstamp_tbl[i] - tstamp_tbl[0]) == target_time
+        else:   # if ts_rel[i] == target_time
 
             BATT_MODEL["voc"][soc_index] = voc_tbl[i]
             BATT_MODEL["vload"][soc_index] = vload_tbl[i]
             BATT_MODEL["esr"][soc_index] = esr_tbl[i]
-            BATT_MODEL["tstamp"][soc_index] = tstamp_tbl[i] - tstamp_tbl[0]	   # Calculate model timestamps relative to timestamp of first raw timestamp
+            BATT_MODEL["tstamp"][soc_index] = ts_rel[i]	   # Calculate model timestamps relative to timestamp of first raw timestamp
             start_index = i
 
             
@@ -676,9 +861,9 @@ def extract_model(debug):
     BATT_MODEL["voc"][0] = voc_tbl[max_index]
     BATT_MODEL["vload"][0] = vload_tbl[max_index]
     BATT_MODEL["esr"][0] = esr_tbl[max_index]
-    BATT_MODEL["tstamp"][0] = tstamp_tbl[max_index] - tstamp_tbl[0]	# Calculate model timestamps relative to timestamp of first raw timestamp
+    BATT_MODEL["tstamp"][0] = ts_rel[max_index]	# Calculate model timestamps relative to timestamp of first raw timestamp
 
-    BATT_MODEL["capacity"] = Dround(BATT_MODEL_RAW["capacity"], 4)
+    BATT_MODEL["capacity"] = round(BATT_MODEL_RAW["capacity"], 4)
 
     if debug:
         print(0, BATT_MODEL["soc"][0], 100*model_interval, max_index, BATT_MODEL["tstamp"][0], BATT_MODEL["voc"][0], BATT_MODEL["vload"][0], BATT_MODEL["esr"][0])
@@ -692,19 +877,25 @@ def save_model(debug):
     
     filename = TEST_PARAM["batt_model_filename"]
 
-    file = open(filename, "w")
-
-    file.write("PW_MODEL_PW2281S_20_6 \n");
+    lines = ["PW_MODEL_PW2281S_20_6 \n",
+             f"Capacity={BATT_MODEL['capacity']}AH\n",
+             "SOC(%), Open Voltage(V), ESR(ohm)\n"]
+    lines += [f"{soc}, {voc}, {esr:.7g} \n" for soc, voc, esr in zip(BATT_MODEL["soc"], BATT_MODEL["voc"], BATT_MODEL["esr"])]
 
-    file.write("Capacity=" + str(BATT_MODEL["capacity"]) + "AH\n")
-    file.write("SOC(%), Open Voltage(V), ESR(ohm)\n")
+    with open(filename, "w") as file:
+        file.writelines(lines)
 
-    for i in range(0,101):
-        file.write(str(BATT_MODEL["soc"][i]) + ", " + str(BATT_MODEL["voc"][i]) + ", " + format(BATT_MODEL["esr"][i], '.7g') + " \n")
-    file.close()
+def dump_table(file, writer, name, table):
+    # Header row, then one row per entry: index, timestamp, Voc, Vload, ESR
+    file.write(f"{name}:,Index,Timestamp,Voc,Vload,ESR\n")
+    prefix = name + ":"
+    writer.writerows((prefix, i+1, tstamp, voc, vload, f"{esr:.7g}")
+                     for i, (tstamp, voc, vload, esr) in enumerate(zip(table["tstamp"], table["voc"], table["vload"], table["esr"])))
 
 def save_setup_and_raw_data(debug):
 
+    smu = get_smu()
+
     if debug:
         print("\nIn save_setup_and_raw_data()")
 
@@ -713,51 +904,47 @@ def save_setup_and_raw_data(debug):
 
     filename = TEST_PARAM["batt_model_filename"][:-4] + "_SetupAndRawData.csv"
                                                                             
-    file = open(filename, "w")
-
-    file.write("TEST_PARAM.comment:," + TEST_PARAM["comment"] +"\n")
-    file.write("\n")
-
-
-    smu_id_info = smu.id.split(",")
-    file.write("SourceMeter Model:," + smu_id_info[1].lstrip("MODEL ") +"\n")
-    file.write("SourceMeter S/N:," + smu_id_info[2] + "\n")
-    file.write("SourceMeter Firmware:," + smu_id_info[3].split(" ")[0] + "\n")
-    file.write("\n")
-    file.write("TEST_PARAM.terminals:," + TEST_PARAM["terminals"].upper()  + " TERMINALS\n")
-    file.write("\n")
-    file.write("TEST_PARAM.initial_voc:," + str(TEST_PARAM["initial_voc"]) + "\n")
-    file.write("TEST_PARAM.vcutoff:," + str(TEST_PARAM["vcutoff"]) + "\n")
-    file.write("\n")
-    file.write("TEST_PARAM.discharge_type:," + TEST_PARAM["discharge_type"] + "\n")
-    if TEST_PARAM["discharge_current"] is not None:
-        file.write("TEST_PARAM.discharge_current:," + str(TEST_PARAM["discharge_current"]) + "\n")
-        file.write("TEST_PARAM.max_discharge_current:," + str(TEST_PARAM["max_discharge_current"]) + "\n")
-    if TEST_PARAM["discharge_curr_list"] is not None:
-        file.write("TEST_PARAM.discharge_curr_list:,Index,Current (A),Duration (s)\n")
-        for i in range(0,len(TEST_PARAM["discharge_curr_list"])):
-            file.write(","+ str(i+1) + "," + str(TEST_PARAM["discharge_curr_list"][i]["current"]) + "," + str(TEST_PARAM["discharge_curr_list"][i]["duration"])+"\n")
-        file.write("TEST_PARAM.discharge_curr_list.average_curr:,," + str(TEST_PARAM["discharge_curr_list_average_curr"]) + "\n")
-        file.write("TEST_PARAM.discharge_curr_list.duration:,,," + str(TEST_PARAM["discharge_curr_list_duration"]) + "\n")
-        file.write("TEST_PARAM.discharge_curr_list.max_dur_index:," + str(TEST_PARAM["discharge_curr_list_max_dur_index"]+1) + "\n")
-        file.write("TEST_PARAM.max_discharge_current:," + str(TEST_PARAM["max_discharge_current"]) + "\n")
-    file.write("\n")
-    file.write("TEST_PARAM.measure_interval:," + str(TEST_PARAM["measure_interval"]) + "\n")
-    file.write("\n")
-    file.write("TEST_PARAM.discharge_start_time:," + TEST_PARAM["discharge_start_time"] + "\n")
-    file.write("TEST_PARAM.discharge_stop_time:," + TEST_PARAM["discharge_stop_time"] + "\n")
-    file.write("\n")
-    file.write("BATT_MODEL_RAW:,Index,Timestamp,Voc,Vload,ESR\n")
-    for i in range(0,len(BATT_MODEL_RAW["tstamp"])):
-        file.write("BATT_MODEL_RAW:,"+str(i+1)+","+ str(BATT_MODEL_RAW["tstamp"][i]) + "," + str(BATT_MODEL_RAW["voc"][i]) + "," + str(BATT_MODEL_RAW["vload"][i]) + "," + format(BATT_MODEL_RAW["esr"][i], '.7g') +"\n")
-    file.write("BATT_MODEL_RAW.capacity:," + format(BATT_MODEL_RAW["capacity"], '.7g') +"\n")
-    file.write("\n")
-    file.write("BATT_MODEL:,Index,Timestamp,Voc,Vload,ESR\n")
-    for i in range(0, len(BATT_MODEL["tstamp"])):
-        file.write("BATT_MODEL:," + str(i+1) + "," + str(BATT_MODEL["tstamp"][i]) + "," + str(BATT_MODEL["voc"][i]) + "," + str(BATT_MODEL["vload"][i]) + "," + format(BATT_MODEL["esr"][i], '.7g') + "\n")
-    file.write("BATT_MODEL.capacity:," + str(BATT_MODEL["capacity"]) +"\n")
-    
-    file.close()
+    with open(filename, "w", newline="", buffering=1<<20) as file:   # One large buffer, flushed on close
+        writer = csv.writer(file, lineterminator="\n")
+
+        writer.writerow(["TEST_PARAM.comment:", TEST_PARAM["comment"]])   # Quotes the comment if it contains commas
+
+        model, serial_number, firmware = smu.identity
+
+        lines = ["\n",
+                 f"SourceMeter Model:,{model}\n",
+                 f"SourceMeter S/N:,{serial_number}\n",
+                 f"SourceMeter Firmware:,{firmware}\n",
+                 "\n",
+                 f"TEST_PARAM.terminals:,{TEST_PARAM['terminals'].upper()} TERMINALS\n",
+                 "\n",
+                 f"TEST_PARAM.initial_voc:,{TEST_PARAM['initial_voc']}\n",
+                 f"TEST_PARAM.vcutoff:,{TEST_PARAM['vcutoff']}\n",
+                 "\n",
+                 f"TEST_PARAM.discharge_type:,{TEST_PARAM['discharge_type']}\n"]
+        if TEST_PARAM["discharge_current"] is not None:
+            lines += [f"TEST_PARAM.discharge_current:,{TEST_PARAM['discharge_current']}\n",
+                      f"TEST_PARAM.max_discharge_current:,{TEST_PARAM['max_discharge_current']}\n"]
+        if TEST_PARAM["discharge_curr_list"] is not None:
+            lines.append("TEST_PARAM.discharge_curr_list:,Index,Current (A),Duration (s)\n")
+            lines += [f",{i+1},{entry['current']},{entry['duration']}\n" for i, entry in enumerate(TEST_PARAM["discharge_curr_list"])]
+            lines += [f"TEST_PARAM.discharge_curr_list.average_curr:,,{TEST_PARAM['discharge_curr_list_average_curr']}\n",
+                      f"TEST_PARAM.discharge_curr_list.duration:,,,{TEST_PARAM['discharge_curr_list_duration']}\n",
+                      f"TEST_PARAM.discharge_curr_list.max_dur_index:,{TEST_PARAM['discharge_curr_list_max_dur_index']+1}\n",
+                      f"TEST_PARAM.max_discharge_current:,{TEST_PARAM['max_discharge_current']}\n"]
+        lines += ["\n",
+                  f"TEST_PARAM.measure_interval:,{TEST_PARAM['measure_interval']}\n",
+                  "\n",
+                  f"TEST_PARAM.discharge_start_time:,{TEST_PARAM['discharge_start_time']}\n",
+                  f"TEST_PARAM.discharge_stop_time:,{TEST_PARAM['discharge_stop_time']}\n",
+                  "\n"]
+        file.write("".join(lines))
+
+        dump_table(file, writer, "BATT_MODEL_RAW", BATT_MODEL_RAW)
+        file.write(f"BATT_MODEL_RAW.capacity:,{BATT_MODEL_RAW['capacity']:.7g}\n")
+        file.write("\n")
+        dump_table(file, writer, "BATT_MODEL", BATT_MODEL)
+        file.write("BATT_MODEL.capacity:," + str(BATT_MODEL["capacity"]) +"\n")
 
 def run_test(do_beeps, debug):
 
@@ -775,7 +962,7 @@ def run_test(do_beeps, debug):
     dialog_text = "Select OK to START TEST, or Cancel to ABORT and EXIT."
 
     if do_beeps:
-        smu.beep(2400, 0.08)
+        beep()
         
     selection = prompt_choice(dialog_text, ["OK", "Cancel"])
     if selection == "Cancel":
@@ -812,17 +999,29 @@ def run_test(do_beeps, debug):
 
     save_setup_and_raw_data(debug)
 
-debug = False
-do_beeps = True
+if __name__ == "__main__":
 
-print("\nBattery Discharge Driver for Keithley 2400 SourceMeter\n")
-print("Follow all manufacturer's guidelines to ensure safe operation when\ndischarging a battery (especially a LITHIUM ION battery)!")
+    debug = False
+    do_beeps = True
 
-selection = prompt_choice("Proceed?", ["OK", "Cancel"])
+    print("\nBattery Discharge Driver for Keithley 2400 SourceMeter\n")
+    print("Follow all manufacturer's guidelines to ensure safe operation when\ndischarging a battery (especially a LITHIUM ION battery)!")
+
+    selection = prompt_choice("Proceed?", ["OK", "Cancel"])
+
+    if selection == "Cancel":
+        raise Exception("run_test aborted by user")
 
-if selection == "Cancel":
-    raise Exception("run_test aborted by user")
+    smu = get_smu()
 
-run_test(do_beeps, debug)
+    try:
+        run_test(do_beeps, debug)
+    finally:
+        # Restore the front panel display and auto-zero disabled in config_system(). If the link to the
+        # SMU is what failed, this write fails too; report it without hiding the original exception.
+        try:
+            smu.write(":DISP:ENAB ON;:SYST:AZER:STAT ON")
+        except Exception as err:
+            print(f"\nCould not restore SMU display and auto-zero: {err}")
 
-smu.beep(2400, 0.08)
+    beep()